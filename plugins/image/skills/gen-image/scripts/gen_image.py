@@ -10,106 +10,336 @@ Requires:
 """
 
 import argparse
-import base64
+import asyncio
+import binascii
+import hashlib
+import json
+import logging
 import os
+import random
+import shutil
 import sys
+import tempfile
 from abc import ABC, abstractmethod
 from pathlib import Path
 
 
+# 固定名称：作为脚本运行时 __name__ 为 "__main__"
+logger = logging.getLogger("gen_image")
+
+# 限流 / 服务繁忙时的重试配置
+RETRYABLE_STATUS_CODES = {429, 503}
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+
+# 流式下载图像时每次写盘的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# gpt-image 系列流式生成时返回的预览图数量
+PARTIAL_IMAGES = 2
+
+# 相同 prompt 的生成结果缓存目录（--cache 开启）
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "superplugins" / "genimage"
+# --cache-compress 使用的 zstd 压缩级别
+CACHE_ZSTD_LEVEL = 3
+
+# gen_image_daemon.py 默认监听的 Unix socket；优先放在仅当前用户可访问的 $XDG_RUNTIME_DIR
+DEFAULT_SOCKET_PATH = os.path.join(os.getenv("XDG_RUNTIME_DIR") or "/tmp", "superplugins-genimage.sock")
+
+# SDK 模块由 get_provider 一次性导入后缓存，生成路径上不再重复 import
+_genai = None
+_genai_types = None
+_openai = None
+_httpx = None
+_zstd = None
+
+# 已创建的输出目录；daemon 中跨请求保留，同一目录只 mkdir 一次
+_created_dirs = set()
+
+# --sse 模式：进度以 Server-Sent Events 格式写入 stdout
+_sse_mode = False
+
+
 # --- Providers ---
 
 class ImageProvider(ABC):
     """图像生成提供者抽象基类"""
+
+    # 支持单次请求原生生成多张图像的模型及数量上限，未列出的模型每次只生成一张
+    BATCH_LIMITS = {}
+
     @abstractmethod
-    def generate(self, prompt: str, model: str) -> bytes:
+    def target_model(self, model: str) -> str:
+        """返回实际使用的模型名称，未指定时为 provider 的默认模型"""
+        pass
+
+    def max_batch_size(self, model: str) -> int:
+        """单次请求可原生生成的图像数量上限，超出部分由调用方拆分为并发请求"""
+        return self.BATCH_LIMITS.get(self.target_model(model), 1)
+
+    @abstractmethod
+    async def generate_async(self, prompt: str, model: str, count: int = 1, on_progress=None) -> list:
         """
-        生成图像
+        异步生成图像，基于 SDK 原生异步客户端（不占用线程），便于批量 prompt 并发执行
         :param prompt: 提示词
         :param model: 模型名称
-        :return: 图像的二进制数据 (bytes)
+        :param count: 图像数量，不超过 max_batch_size
+        :param on_progress: 可选回调，流式响应每到达一个分块时以进度描述调用
+        :return: 图像的二进制数据列表 (list[bytes])
+        """
+        pass
+
+    async def generate_to_file_async(self, prompt: str, model: str, out_paths: list, on_progress=None) -> int:
+        """
+        异步生成 len(out_paths) 张图像并依次写入；默认先取得完整字节再写盘，支持流式下载的 provider 可覆盖
+        :return: 按 out_paths 顺序实际写入的图像数量
         """
+        images = await self.generate_async(prompt, model, len(out_paths), on_progress)
+        for out_path, image_bytes in zip(out_paths, images):
+            # 磁盘写入交给线程池，事件循环可以继续接收其它 provider 的响应
+            await asyncio.to_thread(write_image, out_path, image_bytes)
+        return min(len(images), len(out_paths))
+
+    async def aclose(self):
+        """释放 provider 持有的连接资源"""
         pass
 
 
 class GeminiProvider(ImageProvider):
     """Google Gemini 图像生成实现"""
-    
-    def generate(self, prompt: str, model: str) -> bytes:
+
+    # 图像输出模型（含默认的 gemini-3-pro-image-preview）不接受 candidate_count>1，
+    # 多张图像拆分为并发请求；确认支持的模型可在此加入上限
+    BATCH_LIMITS = {}
+
+    def __init__(self):
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("Environment variable GEMINI_API_KEY is not set.")
 
-        try:
-            from google import genai
-            from google.genai import types
-        except ImportError:
-            raise ImportError("google-genai is not installed. Install with: pip install google-genai")
+        # 客户端在整个批次内复用，连接池与 TLS 会话不必每张图重建
+        self.client = _genai.Client(api_key=api_key)
 
-        client = genai.Client(api_key=api_key)
-        
-        # 注意：原代码 model 默认为 "gemini-3-pro-image-preview"
-        target_model = model if model else "gemini-3-pro-image-preview"
-        
-        response = client.models.generate_content(
-            model=target_model,
+    async def generate_async(self, prompt: str, model: str, count: int = 1, on_progress=None) -> list:
+        # client.aio 为 SDK 原生异步接口，不占用线程；
+        # 流式接口在首个分块到达时即可反馈进度，总数据量不变
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.target_model(model),
             contents=prompt,
-            config=types.GenerateContentConfig(response_modalities=["IMAGE"]),
+            config=_genai_types.GenerateContentConfig(
+                response_modalities=["IMAGE"],
+                candidate_count=count if count > 1 else None,
+            ),
         )
-        
-        return self._extract_image_bytes(response)
-
-    def _extract_image_bytes(self, response):
-        """从 Gemini 响应中提取图像字节"""
-        parts = getattr(response, "parts", None)
-        if not parts:
-            candidates = getattr(response, "candidates", None) or []
-            if candidates:
-                content = getattr(candidates[0], "content", None)
-                parts = getattr(content, "parts", None)
-        parts = parts or []
+
+        images = {}
+        received = 0
+        async for chunk in stream:
+            received += 1
+            if on_progress:
+                on_progress(f"received chunk {received}")
+            # 图像以完整的 inline_data part 出现在某个分块中，按候选序号收集
+            for position, candidate in enumerate(chunk.candidates or ()):
+                index = candidate.index
+                if index is None:
+                    index = position
+                if index not in images:
+                    image_bytes = self._extract_image_bytes(candidate)
+                    if image_bytes:
+                        images[index] = image_bytes
+        return [images[index] for index in sorted(images)]
+
+    def target_model(self, model: str) -> str:
+        # 注意：原代码 model 默认为 "gemini-3-pro-image-preview"
+        return model if model else "gemini-3-pro-image-preview"
+
+    def _extract_image_bytes(self, candidate):
+        """从 Gemini 候选结果中提取图像字节"""
+        # SDK 响应为类型化模型，字段恒存在但可能为 None，直接访问即可
+        try:
+            parts = candidate.content.parts or ()
+        except AttributeError:
+            return None
         for part in parts:
-            inline = getattr(part, "inline_data", None)
-            data = getattr(inline, "data", None) if inline else None
-            if data:
-                if isinstance(data, str):
-                    try:
-                        return base64.b64decode(data)
-                    except Exception:
-                        return data.encode("utf-8")
-                return data
+            inline = part.inline_data
+            # Blob.data 声明为 bytes，SDK 已完成 base64 解码，无需再区分 str
+            if inline is not None and inline.data:
+                return inline.data
         return None
 
 
 class OpenAIProvider(ImageProvider):
     """OpenAI 图像生成实现"""
 
-    def generate(self, prompt: str, model: str) -> bytes:
+    # 支持 response_format="url" 的模型，可直接从 URL 流式下载到磁盘
+    URL_RESPONSE_MODELS = {"dall-e-2", "dall-e-3"}
+    # 支持 n>1 原生批量生成的模型及上限；dall-e-3 与 gpt-image 流式预览每次只生成一张
+    BATCH_LIMITS = {"dall-e-2": 10}
+
+    def __init__(self):
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("Environment variable OPENAI_API_KEY is not set.")
 
-        try:
-            from openai import OpenAI
-        except ImportError:
-            raise ImportError("openai is not installed. Install with: pip install openai")
-
-        client = OpenAI(api_key=api_key)
-        
-        target_model = model if model else "dall-e-3"
+        # 客户端在整个批次内复用：AsyncOpenAI 与下载用的 httpx.AsyncClient 各自维护连接池；
+        # 关闭 SDK 内置重试，429/503 统一由 generate_with_retry 处理，避免重试次数叠加
+        self.async_client = _openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.http = _httpx.AsyncClient(follow_redirects=True)
 
+    async def generate_async(self, prompt: str, model: str, count: int = 1, on_progress=None) -> list:
         # 调用 OpenAI API
         # response_format="b64_json" 直接返回 base64 数据，比 url 更稳健
-        response = client.images.generate(
-            model=target_model,
+        response = await self.async_client.images.generate(
+            model=self.target_model(model),
             prompt=prompt,
             response_format="b64_json",
-            n=1,
+            n=count,
             # size="1024x1024" # 默认为 1024x1024
         )
 
-        b64_data = response.data[0].b64_json
-        return base64.b64decode(b64_data)
+        return [binascii.a2b_base64(item.b64_json) for item in response.data if item.b64_json]
+
+    async def generate_to_file_async(self, prompt: str, model: str, out_paths: list, on_progress=None) -> int:
+        target_model = self.target_model(model)
+        if target_model.startswith("gpt-image"):
+            saved = await self._stream_partial_images(prompt, target_model, out_paths[0], on_progress)
+            return int(saved)
+        if target_model not in self.URL_RESPONSE_MODELS:
+            return await super().generate_to_file_async(prompt, model, out_paths, on_progress)
+
+        # 请求 URL 而非 b64_json，图像分块写盘，不在内存中保留完整数据
+        response = await self.async_client.images.generate(
+            model=target_model,
+            prompt=prompt,
+            response_format="url",
+            n=len(out_paths),
+        )
+
+        urls = [item.url for item in response.data if item.url]
+        if urls and on_progress:
+            on_progress("downloading")
+        tasks = [asyncio.create_task(stream_to_file(self.http, url, out_path)) for url, out_path in zip(urls, out_paths)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # 任一下载失败时 gather 不会取消其余下载，需显式取消并等待其清理完毕，
+            # 否则它们会在 provider.aclose() 关闭 self.http 之后继续运行（daemon 中会泄漏）
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return min(len(urls), len(out_paths))
+
+    async def _stream_partial_images(self, prompt, target_model, out_path, on_progress):
+        """gpt-image 系列支持流式生成：预览图依次写入 out_path，最终由完整图像覆盖"""
+        stream = await self.async_client.images.generate(
+            model=target_model,
+            prompt=prompt,
+            n=1,
+            stream=True,
+            partial_images=PARTIAL_IMAGES,
+        )
+
+        try:
+            async for event in stream:
+                if event.type == "image_generation.partial_image":
+                    if on_progress:
+                        on_progress(f"partial image {event.partial_image_index + 1}/{PARTIAL_IMAGES}")
+                    await asyncio.to_thread(write_image, out_path, binascii.a2b_base64(event.b64_json))
+                elif event.type == "image_generation.completed":
+                    await asyncio.to_thread(write_image, out_path, binascii.a2b_base64(event.b64_json))
+                    return True
+        except BaseException:
+            # 不保留半成品预览图
+            out_path.unlink(missing_ok=True)
+            raise
+        out_path.unlink(missing_ok=True)
+        return False
+
+    async def aclose(self):
+        await self.async_client.close()
+        await self.http.aclose()
+
+    def target_model(self, model: str) -> str:
+        return model if model else "dall-e-3"
+
+
+def ensure_dirs(paths):
+    """创建输出路径所在目录，已创建过的目录直接跳过"""
+    for parent in {path.parent for path in paths} - _created_dirs:
+        parent.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(parent)
+
+
+def open_for_write(out_path):
+    """以 os.open 打开输出文件；目录在 ensure_dirs 之后被删除时补建一次"""
+    flags = os.O_CREAT | os.O_WRONLY | os.O_TRUNC
+    try:
+        return os.open(out_path, flags, 0o644)
+    except FileNotFoundError:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(out_path, flags, 0o644)
+
+
+def write_all(fd, data):
+    """os.write 可能只写入部分数据，循环直到写完"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def close_output(fd, out_path, completed):
+    """关闭输出文件；未完整写入时删除，不保留半成品"""
+    os.close(fd)
+    if not completed:
+        out_path.unlink(missing_ok=True)
+
+
+def write_image(out_path, data):
+    """直接通过文件描述符写入图像，省去 pathlib 与缓冲文件对象的开销"""
+    fd = open_for_write(out_path)
+    try:
+        write_all(fd, data)
+    finally:
+        os.close(fd)
+
+
+async def stream_to_file(http, url, out_path):
+    """使用 httpx.AsyncClient 将 URL 内容按块流式写入 out_path，失败时删除不完整的文件"""
+    async with http.stream("GET", url) as response:
+        response.raise_for_status()
+        # 文件操作全部交给线程池：NFS/FUSE 等慢速挂载上 open/mkdir/write 都可能阻塞事件循环
+        fd = await asyncio.to_thread(open_for_write, out_path)
+        pending = None
+        completed = False
+        try:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                # shield：任务被取消时写入线程仍会执行完，关闭 fd 前需等待，避免写入已被复用的描述符
+                pending = asyncio.ensure_future(asyncio.to_thread(write_all, fd, chunk))
+                await asyncio.shield(pending)
+            completed = True
+        finally:
+            if pending is not None:
+                await asyncio.wait([pending])
+            await asyncio.to_thread(close_output, fd, out_path, completed)
+
+
+def _ensure_imports(name):
+    """一次性导入 provider 所需的 SDK 并缓存到模块级变量"""
+    global _genai, _genai_types, _openai, _httpx
+    if name == "gemini" and _genai is None:
+        try:
+            from google import genai
+            from google.genai import types
+        except ImportError:
+            raise ImportError("google-genai is not installed. Install with: pip install google-genai")
+        _genai, _genai_types = genai, types
+    elif name == "openai" and _openai is None:
+        try:
+            import httpx  # openai SDK 的依赖
+            import openai
+        except ImportError:
+            raise ImportError("openai is not installed. Install with: pip install openai")
+        _openai, _httpx = openai, httpx
 
 
 def get_provider(name: str) -> ImageProvider:
@@ -120,16 +350,116 @@ def get_provider(name: str) -> ImageProvider:
     }
     if name not in providers:
         raise ValueError(f"Unknown provider: {name}. Available: {list(providers.keys())}")
+    _ensure_imports(name)
     return providers[name]()
 
 
+# --- Cache ---
+
+def _ensure_zstd():
+    """一次性导入 zstandard（仅 --cache-compress 需要）"""
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is not installed. Install with: pip install zstandard")
+        _zstd = zstandard
+
+
+def cache_path_for(cache_dir, provider_name, model, prompt, variant=0, compress=False):
+    """
+    按 provider、模型、prompt 及同一 prompt 下的图像序号计算缓存文件路径，压缩条目以 .zst 结尾
+    :param model: 已解析的模型名称（见 ImageProvider.target_model），省略 --model 与显式指定默认模型命中同一条目
+    """
+    source = f"{provider_name}|{model}|{prompt}"
+    if variant:
+        source += f"|{variant}"
+    key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    return cache_dir / (f"{key}.png.zst" if compress else f"{key}.png")
+
+
+def load_from_cache(cache_path, out_path):
+    """将缓存条目还原到 out_path，.zst 条目流式解压；条目不存在（包括刚被并发删除）时返回 False"""
+    try:
+        src = open(cache_path, "rb")
+    except FileNotFoundError:
+        return False
+    # 经 open_for_write 打开：目录在 ensure_dirs 记录后被删除时同样会补建
+    with src, os.fdopen(open_for_write(out_path), "wb") as dst:
+        if cache_path.suffix == ".zst":
+            _zstd.ZstdDecompressor().copy_stream(src, dst)
+        else:
+            shutil.copyfileobj(src, dst)
+    return True
+
+
+def write_cache_entry(cache_path, write):
+    """调用 write(dst) 写入 cache_dir 下的临时文件，完成后 os.replace 就位；中断或并发读取时不会看到不完整的条目"""
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            write(dst)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def store_in_cache(out_path, cache_path):
+    """
+    将生成结果复制进缓存，.zst 条目流式压缩；
+    不与输出文件共享 inode，其它工具原地改写输出文件不会连带修改缓存条目
+    """
+    def copy(dst):
+        with open(out_path, "rb") as src:
+            if cache_path.suffix == ".zst":
+                _zstd.ZstdCompressor(level=CACHE_ZSTD_LEVEL).copy_stream(src, dst)
+            else:
+                shutil.copyfileobj(src, dst)
+
+    write_cache_entry(cache_path, copy)
+
+
 # --- Main ---
 
+def report(stage, message, error=False, **fields):
+    """
+    输出进度：--sse 模式下写出 `data: {"stage": ...}` 事件供上层 UI 解析，否则打印文本
+    :param message: 文本模式下的输出内容，为 None 时仅在 SSE 模式下输出
+    :param error: 文本模式下是否写入 stderr
+    """
+    if _sse_mode:
+        event = {"stage": stage, **fields}
+        if message:
+            event["message"] = message
+        sys.stdout.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+        sys.stdout.flush()
+    elif message:
+        print(message, file=sys.stderr if error else sys.stdout)
+
+
 def parse_args():
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description="Generate a PNG image using AI providers.")
-    parser.add_argument("--prompt", required=True, help="Final prompt to send to the model")
-    parser.add_argument("--out", required=True, help="Output file path (PNG)")
+    prompts = parser.add_mutually_exclusive_group(required=True)
+    prompts.add_argument(
+        "--prompt",
+        action="append",
+        help="Final prompt to send to the model (repeat to generate several images concurrently)",
+    )
+    prompts.add_argument(
+        "--prompts-file",
+        help="Text file with one prompt per line; lines are streamed to concurrent workers and outputs numbered by line",
+    )
+    parser.add_argument(
+        "--out",
+        required=True,
+        help=(
+            "Output file path (PNG); may contain {i} for the image index, "
+            "otherwise _1, _2, ... is appended when several images are generated"
+        ),
+    )
     parser.add_argument(
         "--provider",
         default="gemini",
@@ -140,58 +470,343 @@ def parse_args():
         "--model",
         help="Model name (default depends on provider, e.g., gemini-3-pro-image-preview or dall-e-3)",
     )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=1,
+        help="Number of images per prompt; batched into one request where the model supports it (default: 1)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=5,
+        help="Maximum number of in-flight provider requests (default: 5)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reuse a previously generated image for the same provider, model and prompt",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help=f"Cache directory used with --cache (default: {DEFAULT_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--cache-compress",
+        action="store_true",
+        help="Store cache entries zstd-compressed (requires: pip install zstandard)",
+    )
+    parser.add_argument(
+        "--socket",
+        nargs="?",
+        const=DEFAULT_SOCKET_PATH,
+        help=f"Send the request to a running gen_image_daemon.py instead (default socket: {DEFAULT_SOCKET_PATH})",
+    )
+    parser.add_argument(
+        "--sse",
+        action="store_true",
+        help="Write progress to stdout as Server-Sent Events (data: {\"stage\": ...}) for UI integration",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Validate arguments without calling the API",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.prompts_file and not os.access(args.prompts_file, os.R_OK):
+        parser.error(f"--prompts-file {args.prompts_file} does not exist or is not readable")
+    return args
 
 
 def ensure_png_path(path_str):
-    """确保输出路径以 .png 结尾"""
-    if path_str.lower().endswith(".png"):
+    """确保输出路径以 .png 结尾（不区分大小写）"""
+    # 只对末尾 4 个字符做 lower，不复制整条路径
+    if path_str[-4:].lower() == ".png":
         return path_str
     return f"{path_str}.png"
 
 
+def indexed_out_path(path_str, index):
+    """第 index 张图像（从 1 开始）的输出路径：包含 {i} 时替换为序号，否则在文件名后追加 _index"""
+    if "{i}" in path_str:
+        return Path(ensure_png_path(path_str.replace("{i}", str(index))))
+    path = Path(ensure_png_path(path_str))
+    return path.with_name(f"{path.stem}_{index}{path.suffix}")
+
+
+def build_out_paths(path_str, count):
+    """生成 count 个输出路径：单张且不含 {i} 时原样使用，否则按序号生成"""
+    if count == 1 and "{i}" not in path_str:
+        return [Path(ensure_png_path(path_str))]
+    return [indexed_out_path(path_str, i) for i in range(1, count + 1)]
+
+
+def is_retryable(exc):
+    """判断是否为可重试的限流/服务繁忙错误（OpenAI 使用 status_code，Gemini 使用 code）"""
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    return status in RETRYABLE_STATUS_CODES
+
+
+async def generate_with_retry(provider, prompt, model, out_paths, on_progress=None):
+    """调用 provider 生成并写入图像，遇到 429/503 时指数退避重试"""
+    delay = RETRY_BASE_DELAY
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await provider.generate_to_file_async(prompt, model, out_paths, on_progress)
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            wait = delay + random.uniform(0, delay)
+            report(
+                "retry",
+                f"Rate limited, retrying in {wait:.1f}s ({attempt + 1}/{MAX_RETRIES})...",
+                error=True,
+                attempt=attempt + 1,
+                delay=round(wait, 2),
+            )
+            await asyncio.sleep(wait)
+            delay *= 2
+
+
+async def generate_batch(provider, prompt, model, batch, sem):
+    """以一次 provider 请求生成 batch 中 (out_path, cache_path) 对应的全部图像，返回失败的输出路径列表"""
+    out_paths = [out_path for out_path, _ in batch]
+    first_byte = False
+
+    def on_progress(event):
+        nonlocal first_byte
+        if not first_byte:
+            first_byte = True
+            report("first_byte", None, path=str(out_paths[0]))
+        report("progress", f"{out_paths[0].name}: {event}", path=str(out_paths[0]), event=event)
+
+    # 重试在信号量内进行，避免重试请求额外占用并发额度
+    async with sem:
+        report("request_start", None, path=str(out_paths[0]), count=len(out_paths))
+        saved = await generate_with_retry(provider, prompt, model, out_paths, on_progress)
+
+    for out_path, cache_path in batch[:saved]:
+        if cache_path:
+            await asyncio.to_thread(store_in_cache, out_path, cache_path)
+        report("saved", f"Saved image: {out_path}", path=str(out_path))
+    failed = [out_path for out_path, _ in batch[saved:]]
+    for out_path in failed:
+        report("error", f"Error: No image data returned for {out_path}.", error=True, path=str(out_path))
+    return failed
+
+
+async def generate_for_prompt(provider, prompt, model, out_paths, sem, cache_paths):
+    """为一个 prompt 生成 len(out_paths) 张图像并保存，返回失败的输出路径列表；命中缓存的图像直接复用"""
+    pending = []
+    for out_path, cache_path in zip(out_paths, cache_paths):
+        if cache_path and await asyncio.to_thread(load_from_cache, cache_path, out_path):
+            report("saved", f"Saved image (cached): {out_path}", path=str(out_path), cached=True)
+        else:
+            pending.append((out_path, cache_path))
+
+    # 模型支持时多张图像合并为一次请求（n / candidate_count），其余拆分为并发请求
+    size = provider.max_batch_size(model)
+    batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+    failed = await asyncio.gather(*(generate_batch(provider, prompt, model, batch, sem) for batch in batches))
+    return [out_path for paths in failed for out_path in paths]
+
+
+def prompt_cache_paths(provider, args, prompt):
+    """计算一个 prompt 下 args.count 张图像各自的缓存路径，未开启缓存时为 None"""
+    if not args.cache:
+        return [None] * args.count
+    model = provider.target_model(args.model)
+    return [
+        cache_path_for(args.cache_dir, args.provider, model, prompt, variant, args.cache_compress)
+        for variant in range(args.count)
+    ]
+
+
+async def generate_prompt_safely(provider, args, sem, prompt, out_paths):
+    """生成一个 prompt 的图像并返回失败的输出路径列表；运行时错误只记录，不中断其余 prompt"""
+    try:
+        return await generate_for_prompt(
+            provider, prompt, args.model, out_paths, sem, prompt_cache_paths(provider, args, prompt)
+        )
+    except (ImportError, ValueError):
+        raise
+    except Exception as e:
+        report("error", f"Runtime Error ({out_paths[0]}): {e}", error=True, path=str(out_paths[0]))
+        return out_paths
+
+
+async def generate_from_prompts_file(provider, args, sem):
+    """按行流式读取 --prompts-file，经有界队列分发给 args.concurrency 个 worker，返回 (输出路径列表, 失败的输出路径列表)"""
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    out_paths = {}
+    failed = []
+
+    async def producer():
+        # 单行读取耗时可忽略，直接同步读取；队列满时在此等待，内存占用与文件大小无关
+        try:
+            f = open(args.prompts_file, encoding="utf-8")
+        except OSError as e:
+            # 文件由用户指定（daemon 收到请求时可能已被删除），按配置错误处理，不输出 traceback
+            raise ValueError(f"Cannot read prompts file: {e}") from e
+        with f:
+            # 输出序号与 prompt 所在行号对应，空行跳过但占用序号
+            for index, line in enumerate(f):
+                prompt = line.strip()
+                if prompt:
+                    await queue.put((index, prompt))
+        for _ in range(args.concurrency):
+            await queue.put(None)
+
+    async def worker():
+        nonlocal failed
+        while (item := await queue.get()) is not None:
+            index, prompt = item
+            paths = [indexed_out_path(args.out, index * args.count + k) for k in range(1, args.count + 1)]
+            ensure_dirs(paths)
+            out_paths[index] = paths
+            failed.extend(await generate_prompt_safely(provider, args, sem, prompt, paths))
+
+    report(
+        "start",
+        f"Generating images from {args.prompts_file} with {args.provider} (model: {args.model or 'default'})...",
+        provider=args.provider,
+        model=args.model,
+    )
+    tasks = [asyncio.create_task(producer())]
+    tasks += [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # 读取文件失败或 worker 异常时 gather 不会取消其余任务，需显式取消，
+        # 否则 worker 会一直阻塞在 queue.get()（daemon 中会泄漏）或在后台继续生成
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return [path for index in sorted(out_paths) for path in out_paths[index]], failed
+
+
+async def generate_images(provider, args, sem):
+    """使用给定 provider 与信号量并发生成 args 描述的全部图像，返回 (输出路径列表, 失败的输出路径列表)"""
+    if args.cache:
+        if args.cache_compress:
+            _ensure_zstd()
+        args.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.prompts_file:
+        return await generate_from_prompts_file(provider, args, sem)
+
+    out_paths = build_out_paths(args.out, len(args.prompt) * args.count)
+    # 输出目录在并发开始前统一创建，避免每个任务重复 mkdir
+    ensure_dirs(out_paths)
+
+    # 简单的 loading 提示
+    report(
+        "start",
+        f"Generating {len(out_paths)} image(s) with {args.provider} (model: {args.model or 'default'})...",
+        provider=args.provider,
+        model=args.model,
+        count=len(out_paths),
+    )
+
+    # 每个 prompt 对应 out_paths 中连续的 args.count 项；单个 prompt 失败不影响其余结果落盘
+    results = await asyncio.gather(*(
+        generate_prompt_safely(provider, args, sem, prompt, out_paths[i * args.count:(i + 1) * args.count])
+        for i, prompt in enumerate(args.prompt)
+    ))
+    return out_paths, [out_path for paths in results for out_path in paths]
+
+
+def daemon_request(args):
+    """将命令行参数转换为发送给 daemon 的请求；路径转为绝对路径，daemon 的工作目录可能不同"""
+    return {
+        "prompt": args.prompt,
+        "prompts_file": args.prompts_file and os.path.abspath(args.prompts_file),
+        "out": os.path.abspath(args.out),
+        "provider": args.provider,
+        "model": args.model,
+        "count": args.count,
+        "concurrency": args.concurrency,
+        "cache": args.cache,
+        "cache_dir": str(args.cache_dir.resolve()),
+        "cache_compress": args.cache_compress,
+    }
+
+
+async def run_via_daemon(args):
+    """通过 Unix socket 将请求交给常驻的 gen_image_daemon.py，省去解释器启动、SDK 导入与 TLS 建连"""
+    try:
+        reader, writer = await asyncio.open_unix_connection(args.socket)
+    except OSError as e:
+        report("error", f"Daemon Error: cannot reach gen_image_daemon at {args.socket}: {e}", error=True)
+        return 1
+
+    try:
+        writer.write(json.dumps(daemon_request(args)).encode("utf-8") + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+    if not line:
+        report("error", "Daemon Error: gen_image_daemon closed the connection without a response", error=True)
+        return 1
+    response = json.loads(line)
+    # 部分失败时 daemon 同样返回已保存与失败的路径，与进程内生成的输出保持一致
+    for path in response.get("paths", ()):
+        report("saved", f"Saved image: {path}", path=path)
+    for path in response.get("failed", ()):
+        report("error", f"Error: Failed to generate {path}.", error=True, path=path)
+    if not response["ok"]:
+        report("error", f"Runtime Error: {response['error']}", error=True)
+        return 1
+    return 0
+
+
+async def run(args):
+    """并发生成所有 prompt 对应的图像"""
+    if args.socket:
+        return await run_via_daemon(args)
+
+    provider = get_provider(args.provider)
+    try:
+        _, failed = await generate_images(provider, args, asyncio.Semaphore(args.concurrency))
+    finally:
+        await provider.aclose()
+    report("done", None, failed=len(failed))
+    return 1 if failed else 0
+
+
 def main():
     """主函数"""
+    global _sse_mode
     args = parse_args()
+    _sse_mode = args.sse
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
 
     if args.dry_run:
-        print(f"Dry run OK. Provider: {args.provider}, Model: {args.model}")
+        report("done", f"Dry run OK. Provider: {args.provider}, Model: {args.model}", dry_run=True)
         return 0
 
     try:
-        provider = get_provider(args.provider)
-        
-        # 简单的 loading 提示
-        print(f"Generating image with {args.provider} (model: {args.model or 'default'})...")
-        
-        image_bytes = provider.generate(args.prompt, args.model)
-        
-        if not image_bytes:
-            print("Error: No image data returned.", file=sys.stderr)
-            return 1
-            
-        out_path = Path(ensure_png_path(args.out))
-        out_path.parent.mkdir(parents=True, exist_ok=True)
-        out_path.write_bytes(image_bytes)
-
-        print(f"Saved image: {out_path}")
-        return 0
+        return asyncio.run(run(args))
 
     except ImportError as e:
-        print(f"Dependency Error: {e}", file=sys.stderr)
+        report("error", f"Dependency Error: {e}", error=True)
         return 1
     except ValueError as e:
-        print(f"Configuration Error: {e}", file=sys.stderr)
+        report("error", f"Configuration Error: {e}", error=True)
         return 1
     except Exception as e:
-        print(f"Runtime Error: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        report("error", f"Runtime Error: {e}", error=True)
+        # 错误信息已由 report 输出，traceback 仅在开启 DEBUG 日志时格式化
+        logger.debug("Unexpected error while generating images", exc_info=True)
         return 1
 
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Long-lived image generation daemon for gen_image.py.
+
+Keeps the provider SDKs imported and their HTTP clients warm, and serves
+requests from `gen_image.py --socket` over a Unix socket. Each request is a
+single JSON line; the response is one JSON line:
+{"ok": true, "paths": [...], "failed": []} or {"ok": false, "paths": [...], "failed": [...], "error": "..."}.
+
+Supports systemd socket activation (LISTEN_FDS): when started from a .socket
+unit, the inherited listening socket is used instead of --socket.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+from pathlib import Path
+
+import gen_image
+
+
+logger = logging.getLogger("gen_image_daemon")
+
+# systemd socket activation 传入的第一个文件描述符
+SD_LISTEN_FDS_START = 3
+
+
+class ImageDaemon:
+    """常驻服务：请求进入队列，由固定数量的 worker 使用共享的 provider 与信号量处理"""
+
+    def __init__(self, workers, concurrency):
+        self.workers = workers
+        self.concurrency = concurrency
+        # asyncio 原语在 serve() 中创建：Python 3.9 会在构造时绑定事件循环，需与 asyncio.run 的循环一致
+        self.queue = None
+        self.sem = None
+        # provider 按名称懒加载，之后在所有请求间复用（SDK 已导入、连接池保持）
+        self.providers = {}
+
+    async def handle_connection(self, reader, writer):
+        """读取一行 JSON 请求，入队等待 worker 处理，并回写结果"""
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((json.loads(line), future))
+            response = await future
+        except Exception as e:
+            response = {"ok": False, "error": f"Invalid request: {e}"}
+        try:
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def worker(self):
+        """持续从队列取出请求并生成图像"""
+        while True:
+            request, future = await self.queue.get()
+            try:
+                future.set_result(await self.process(request))
+            finally:
+                self.queue.task_done()
+
+    async def process(self, request):
+        """处理单个请求，异常转换为错误响应，不影响 daemon 继续运行"""
+        try:
+            args = argparse.Namespace(**request)
+            args.cache_dir = Path(args.cache_dir)
+            provider = self.providers.get(args.provider)
+            if provider is None:
+                provider = self.providers[args.provider] = gen_image.get_provider(args.provider)
+            out_paths, failed = await gen_image.generate_images(provider, args, self.sem)
+        except ImportError as e:
+            return {"ok": False, "error": f"Dependency Error: {e}"}
+        except (ValueError, TypeError) as e:
+            return {"ok": False, "error": f"Configuration Error: {e}"}
+        except Exception as e:
+            logger.exception("Request failed: %s", request.get("out"))
+            return {"ok": False, "error": str(e)}
+        # 部分失败时仍返回已保存的路径，客户端逐一报告后再以失败退出
+        failed_paths = set(failed)
+        response = {
+            "ok": not failed,
+            "paths": [str(out_path) for out_path in out_paths if out_path not in failed_paths],
+            "failed": [str(out_path) for out_path in failed],
+        }
+        if failed:
+            response["error"] = f"{len(failed)} image(s) failed, see daemon log"
+        return response
+
+    async def serve(self, socket_path):
+        """启动 worker 与 Unix socket 服务，直到进程退出；socket 已被占用时返回 1"""
+        self.queue = asyncio.Queue()
+        self.sem = asyncio.Semaphore(self.concurrency)
+        sock = activated_socket()
+        if sock is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, sock=sock)
+        else:
+            if await socket_in_use(socket_path):
+                print(f"Error: {socket_path} is in use (another daemon is running or not a socket)", file=sys.stderr)
+                return 1
+            # 清理上次异常退出遗留的 socket 文件
+            Path(socket_path).unlink(missing_ok=True)
+            # socket 仅允许当前用户连接：daemon 会以自身权限写入请求中的任意路径
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            finally:
+                os.umask(umask)
+            os.chmod(socket_path, 0o600)
+
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        print(f"gen_image daemon listening on {sock.getsockname() if sock else socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
+            for provider in self.providers.values():
+                await provider.aclose()
+        return 0
+
+
+async def socket_in_use(socket_path):
+    """socket_path 上已有 daemon 在监听，或该路径不是 socket 文件（不可删除）时返回 True"""
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISSOCK(mode):
+        return True
+    try:
+        _, writer = await asyncio.open_unix_connection(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    writer.close()
+    await writer.wait_closed()
+    return True
+
+
+def activated_socket():
+    """若由 systemd socket activation 启动，返回继承的监听 socket，否则返回 None"""
+    if os.getenv("LISTEN_PID") != str(os.getpid()) or os.getenv("LISTEN_FDS") != "1":
+        return None
+    return socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM, fileno=SD_LISTEN_FDS_START)
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="Serve gen_image.py requests from a warm process.")
+    parser.add_argument(
+        "--socket",
+        default=gen_image.DEFAULT_SOCKET_PATH,
+        help=f"Unix socket path to listen on (default: {gen_image.DEFAULT_SOCKET_PATH})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of requests processed at the same time (default: 4)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=5,
+        help="Maximum number of in-flight provider requests across all clients (default: 5)",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return args
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+    # 常驻进程只记录错误；失败详情已以 JSON 形式返回给客户端
+    logging.basicConfig(level=logging.ERROR, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    daemon = ImageDaemon(args.workers, args.concurrency)
+    try:
+        return asyncio.run(daemon.serve(args.socket))
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())